@@ -11,24 +11,40 @@
          trgdata  - the first part of the file name for the specific data that is
                        constructed as <variable_id>_<table_id>
          ddir     - the local directory where downloaded files are put
+         nconn    - the number of FTP connections used to crawl the archive
+                       and download files in parallel
 
    If trgexpt is empty (trgexpt=[]) then no files are downloaded and only the
          listing of the archive is produced
+   The listing is written to CCMI-2022_archive_<YYYYMMDD>.json; if that file
+         already exists from an earlier run on the same day it is read back
+         instead of crawling the archive again
+   If trgexpt is set and there is no listing from the same day, only the
+         directories that can hold the requested files are crawled and no
+         listing is written
+   The variables found in each table directory are also kept from run to run
+         in CCMI-2022_archive_cache.json, so that table directories which have
+         not changed since are not listed again
    The CEDA password is entered at a prompt when the script is run
-   The script requires Python 3.3 or higher
+   The script requires Python 3.7 or higher
 
    Author: David Plummer, Environment and Climate Change Canada
 """
 #
 # Import required python modules
-from ftplib import FTP
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from ftplib import FTP, error_perm, error_temp
+import functools
 import getpass
-import numpy as np
-import pprint
-from copy import deepcopy
+import glob
+import json
 from datetime import datetime
 import os
+import queue
+import socket
 import sys
+import time
 #
 # Specify your CEDA username
 cedauser ='dplummer'
@@ -46,268 +62,413 @@ trgdata = [ 'ta_AmonZ', 'wtem_AmonZ' , 'vtem_AmonZ' , 'o3_AmonZ' , 'o3strat_Amon
 # Define the local directory where data would be put
 ddir='/space/hall4/sitestore/eccc/crd/ccrn/users/rdp001/ccmi-2022/import'
 #
+# Number of FTP connections opened to CEDA to list directories and download
+#    files in parallel
+nconn = 4
+#
 #  ----  pull apart the filenames to get the variables and tables that are
 #        being looked for
 trgxvar = []
-for name in trgdata:
-    trgxvar.append(name.split('_')[0])
-#
 trgtble = []
 for name in trgdata:
-    trgtble.append(name.split('_')[1])
+    parts = name.split('_')
+    if len(parts) != 2:
+        print('  ------ Problems with variable/table combinations', name)
+        exit()
+    trgxvar.append(parts[0])
+    trgtble.append(parts[1])
 #
 nvsrch = len(trgxvar)
-if nvsrch != len(trgtble):
-    print('  ------ Problems with variable/table combinations')
-    exit()
 #
 print(' -- Variables being searched for ', nvsrch)
 for ia in range(nvsrch):
     print(trgxvar[ia] + ' in ' + trgtble[ia])
 #
-#  ---- get login credentials
-prompt = f'Username (default: '+cedauser+'): '
-if sys.stdout.isatty():
-    cuser = input(prompt)
-else:
-    print(prompt, end='', file=sys.stderr)
-    cuser = input()
-cuser = cuser.strip()
-cuser = cuser or cedauser
+#  ----  group the requested variables by table so each table directory
+#        can be matched against its targets with a single set lookup
+trgvars = {}
+for ia in range(nvsrch):
+    trgvars.setdefault(trgtble[ia], set()).add(trgxvar[ia])
+#
+#  ---- the listing of the archive written by an earlier run today, if any
+tday = datetime.utcnow()
+dstring =  tday.strftime('%Y%m%d')
+invfile = 'CCMI-2022_archive_'+dstring+'.json'
+#
+#  ---- the server is only needed if the archive has to be crawled or files
+#       downloaded, so a listing-only run with today's listing already written
+#       does not ask for a password
+useftp = bool(trgexpt) or not os.path.exists(invfile)
 #
-#  ---- login to FTP
-ftpc=FTP('ftp.ceda.ac.uk')
-ftpc.login(user=cuser, passwd=getpass.getpass())
+#  ---- get login credentials
+if useftp:
+    prompt = f'Username (default: '+cedauser+'): '
+    if sys.stdout.isatty():
+        cuser = input(prompt)
+    else:
+        print(prompt, end='', file=sys.stderr)
+        cuser = input()
+    cuser = cuser.strip()
+    cuser = cuser or cedauser
+#
+    cpass = getpass.getpass()
+#
+#  ---- open and login to an FTP connection; the timeout (in seconds) applies
+#       to every read and write on the control and data connections, so a
+#       stalled connection raises an error instead of hanging the script
+ftptmo = 120
+def connect():
+    ftp = FTP('ftp.ceda.ac.uk', timeout=ftptmo)
+    ftp.login(user=cuser, passwd=cpass)
+#
+#      ---- have the operating system probe the control connection while it is
+#           idle, e.g. during a long transfer on another connection, so that
+#           firewalls and NAT gateways do not silently drop it
+    ftp.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        ftp.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+#
+#      ---- only the type, size and modify facts are used from the MLSD listings,
+#           so ask the server to leave the others out for the rest of the
+#           session; a server that does not support this still sends all of them
+    try:
+        ftp.sendcmd('OPTS MLST type;size;modify;')
+    except error_perm:
+        pass
+    return ftp
+#
+#  ---- the logged-in connections not currently in use; the first is opened
+#       straight away so that a wrong password is reported before anything
+#       else is done, and the others as they are needed
+ftpool = queue.Queue()
+if useftp:
+    ftpool.put(connect())
+#
+#  ---- errors after which a connection is no longer usable: the server closed
+#       it (EOFError, or a 421 reply), or the socket failed or timed out
+ftplost = (EOFError, ConnectionError, socket.timeout)
+def is_lost(err):
+    return isinstance(err, ftplost) or (isinstance(err, error_temp)
+                                        and str(err).startswith('421'))
+#
+#  ---- check a connection out of the pool, opening a new one if they are all
+#       in use, and put it back when done unless it has been lost
+@contextlib.contextmanager
+def connection():
+    try:
+        ftp = ftpool.get_nowait()
+    except queue.Empty:
+        ftp = connect()
+    try:
+        yield ftp
+    except Exception as err:
+        if is_lost(err):
+            ftp.close()
+        else:
+            ftpool.put(ftp)
+        raise
+    else:
+        ftpool.put(ftp)
 #
 #  ----  go directly to the top of the CCMI archive
 droot = '/badc/ccmi/data/post-cmip6/ccmi-2022'
-ftpc.cwd(droot)
-#
-#  ----  get the list of institutes
-instts=[]
-inner_list = list(ftpc.mlsd())
-for name, properties in inner_list:
-    if properties['type'] == 'dir':
-        instts.append(name)
-ninst = len(instts)
-print('Number of institutions ', ninst)
-print(instts)
-#
-#  ----  the directory structure will be constructed in the
-#        nested list invntry
-invntry=[]
-#
-#  ----  get the list of models
-nmdls = np.zeros(ninst, dtype=int)
-for ia in range(ninst):
-    ftpc.cwd(droot+'/'+instts[ia])
-    mname=[]
-    inner_list = list(ftpc.mlsd())
-    for name, properties in inner_list:
-        if properties['type'] == 'dir':
-            mname.append(name)
-    nmdls[ia] = len(mname)
-    work = [instts[ia], mname]
-    invntry.append(work)
-#
-tnmdls = sum(nmdls)
-print('Total number of models', tnmdls)
-print('Number of models for each institution')
-print(nmdls)
-#
-#  ----  get the list of experiments
-#    ----  direct reference to list avoids recursive problems
-icnt1 = 0
-nxpts = np.zeros(tnmdls, dtype=int)
-for ia in range(ninst):
-    twork = deepcopy(invntry[ia])
-    for ib in range(nmdls[ia]):
-        ftpc.cwd(droot+'/'+twork[0]+'/'+twork[1][ib])
-        inner_list = list(ftpc.mlsd())
-        ip=0
-        for name, properties in inner_list:
-            if properties['type'] == 'dir':
-                invntry[ia][1].insert(2*ib+ip+1, [name])
-                ip += 1
-        nxpts[icnt1] = ip
-        icnt1 += 1
-#
-tnxpts = sum(nxpts)
-print('Total number of experiments ', tnxpts)
-print('Number of experiments ', nxpts)
-#
-#  ----  for each experiment, get the runs
-icnt1 = 0
-icnt2 = 0
-nsims = np.zeros(tnxpts, dtype=int)
-for ia in range(ninst):
-    for ib in range(1,nmdls[ia]+1):
-        mdl = invntry[ia][ib][0]
-        twork = deepcopy(invntry[ia][ib])
-        for ic in range(1,nxpts[icnt1]+1):
-            expt = twork[ic][0]
-            ftpc.cwd(droot+'/'+invntry[ia][0]+'/'+mdl+'/'+expt)
-            inner_list = list(ftpc.mlsd())
-            ip=0
-            for name, properties in inner_list:
-                if properties['type'] == 'dir':
-                    invntry[ia][ib][ic].insert(1+ip, [name])
-                    ip +=1
-            nsims[icnt2] = ip
-            icnt2 += 1
-        icnt1 += 1
-#
-tnsims = sum(nsims)
-print('Total number of simulations ',tnsims)
-print('Number of simulations for each experiment')
-print(nsims)
-#
-#  ---- for each experiment get the MIP tables (Amon, AmonZ, etc.) for
-#       which variables have been provided
-icnt1 = 0
-icnt2 = 0
-icnt3 = 0
-ntabs = np.zeros(tnsims, dtype=int)
-for ia in range(ninst):
-    for ib in range(1,nmdls[ia]+1):
-        mdl = invntry[ia][ib][0]
-        for ic in range(1,nxpts[icnt1]+1):
-            expt = invntry[ia][ib][ic][0]
-            twork = deepcopy(invntry[ia][ib][ic])
-            for id in range(1,nsims[icnt2]+1):
-                rsim = twork[id][0]
-                ip=0
-                ftpc.cwd(droot+'/'+invntry[ia][0]+'/'+mdl+'/'+expt+'/'+rsim)
-                inner_list = list(ftpc.mlsd())
-                for name, properties in inner_list:
-                    if properties['type'] == 'dir':
-                        invntry[ia][ib][ic][id].insert(1+ip, [name])
-                        ip +=1
-                ntabs[icnt3] = ip
-                icnt3 += 1
-            icnt2 += 1
-        icnt1 += 1
-#
-tntabs = sum(ntabs)
-print('Total number of individual MIP tables ',tntabs)
-print('Number of MIP tables provided for each simulation')
-print(ntabs)
-#
-#  ---- deduce the available variables from the directory names, rather
-#       than the individual files
-icnt1 = 0
-icnt2 = 0
-icnt3 = 0
-icnt4 = 0
-nvars = np.zeros(tntabs, dtype=int)
-for ia in range(ninst):
-    for ib in range(1,nmdls[ia]+1):
-        mdl = invntry[ia][ib][0]
-        for ic in range(1,nxpts[icnt1]+1):
-            expt = invntry[ia][ib][ic][0]
-            for id in range(1,nsims[icnt2]+1):
-                rsim = invntry[ia][ib][ic][id][0]
-                twork = deepcopy(invntry[ia][ib][ic][id])
-                for ie in range(1,ntabs[icnt3]+1):
-                    mtab = twork[ie][0]
-                    print('Searching ---', ia, ib, ic, id, ie, mdl, expt, rsim, mtab)
-                    ip=0
-                    ftpc.cwd(droot+'/'+invntry[ia][0]+'/'+mdl+'/'+expt+'/'+rsim+
-                               '/'+mtab)
-                    inner_list = list(ftpc.mlsd())
-                    for name, properties in inner_list:
-                        if properties['type'] == 'dir':
-                            invntry[ia][ib][ic][id][ie].insert(1+ip, [name])
-                            ip +=1
-                    nvars[icnt4] = ip
-                    icnt4 += 1
-                icnt3 += 1
-            icnt2 += 1
-        icnt1 += 1
-#
-tnvars = sum(nvars)
-print('Total number of individual variables ',tnvars)
-print('Number of variables in each table directory')
-print(nvars)
+#
+#  ----  number of attempts made at each FTP operation before giving up
+ntry = 5
+#
+#  ----  retry an FTP operation when the server answers with a transient (4xx)
+#        error or the connection is lost, waiting 1, 2, 4, ... seconds between
+#        attempts; a lost connection has been dropped from the pool, so the
+#        next attempt logs in again
+def retried(func):
+    @functools.wraps(func)
+    def wrapper(*args):
+        for itry in range(ntry):
+            try:
+                return func(*args)
+            except (error_temp,) + ftplost as err:
+                if itry == ntry - 1:
+                    raise
+                print('  ------ FTP error, trying again:', repr(err))
+                time.sleep(2 ** itry)
+    return wrapper
+#
+#  ----  return the names of the subdirectories of a directory in the archive,
+#        each with its modification time (None if the server does not report one)
+@retried
+def list_dirs(path):
+    with connection() as ftp:
+        ftp.cwd(path)
+        return {name: properties.get('modify')
+                for name, properties in ftp.mlsd() if properties['type'] == 'dir'}
+#
+#  ----  return the names and sizes (None if the server does not report one)
+#        of the files in a directory in the archive
+@retried
+def list_files(path):
+    with connection() as ftp:
+        ftp.cwd(path)
+        return {name: int(properties['size']) if 'size' in properties else None
+                for name, properties in ftp.mlsd() if properties['type'] == 'file'}
+#
+#  ----  retrieve a file from a directory in the archive, writing it under a
+#        temporary name and only renaming it once the transfer is complete so
+#        an interrupted run never leaves a truncated file under the final name.
+#        The temporary name carries the version directory the file comes
+#        from, since the same file name can be published again in a later
+#        version, and a .part file left by an earlier run is only resumed with
+#        REST if it was read from the same version and is not already longer
+#        than the remote file. Partial files of the same name from any other
+#        version, or from before the version was part of the name, are
+#        deleted, so a file only ever reaches its final name, and is then
+#        skipped by size, after a transfer from a single version. Data are read from the connection in blocks
+#        of blksize bytes rather than ftplib's default of 8 KiB. The file is
+#        written to ddir by its full path so the worker threads never depend
+#        on the current directory
+blksize = 1 << 20
+@retried
+def get_file(path, name, size=None):
+    lfile = os.path.join(ddir, name)
+    part = lfile + '.' + path.rsplit('/', 1)[1] + '.part'
+    for stale in glob.glob(glob.escape(lfile) + '*.part'):
+        if stale != part:
+            os.remove(stale)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if size is not None and offset > size:
+        offset = 0
+    if offset == 0 or size is None or offset < size:
+        with connection() as ftp:
+            ftp.cwd(path)
+            try:
+                with open(part, 'ab' if offset else 'wb') as out:
+                    ftp.retrbinary('RETR %s' % name, out.write, blocksize=blksize,
+                                   rest=offset or None)
+            except error_perm:
+                if not offset:
+                    raise
+#              ---- the server refused to restart the transfer, so start over
+                with open(part, 'wb') as out:
+                    ftp.retrbinary('RETR %s' % name, out.write, blocksize=blksize)
+    os.replace(part, lfile)
+#
+#  ----  return the path of the latest version directory below a variable
+#        directory, with the names and sizes of the files in it; a variable
+#        directory with no grid or version directory below it is reported
+#        and gives no files, rather than stopping the other downloads
+def find_files(vpath):
+    gdir = next(iter(list_dirs(vpath)), None)
+    if gdir is None:
+        print('  ------ No grid directory in', vpath)
+        return vpath, {}
+    gpath = vpath+'/'+gdir
+#
+#      ------ there may be more than one version directory so we take the
+#             one with the latest date from its vYYYYMMDD name; the listing
+#             order is not guaranteed, and names without a date never win.
+#             Between directories with the same date, or none, the one
+#             modified last on the server is taken
+    ldirs = list_dirs(gpath)
+    if not ldirs:
+        print('  ------ No version directory in', gpath)
+        return gpath, {}
+    vdir = max(ldirs, key=lambda name: (int(name[1:]) if name[1:].isdigit() else -1,
+                                        ldirs[name] or ''))
+    return gpath+'/'+vdir, list_files(gpath+'/'+vdir)
+#
+#  ----  the levels of the archive below droot, from the top down
+levels = ['institution', 'model', 'experiment', 'simulation', 'MIP table', 'variable']
+#
+#  ----  return the names of the subdirectories at the given level below path
+#        that can lead to a requested file, or None if all of them can
+def targets(level, path):
+    if levels[level] == 'experiment':
+        return set(trgexpt)
+    if levels[level] == 'MIP table':
+        return trgvars.keys()
+    if levels[level] == 'variable':
+        return trgvars[path.rsplit('/', 1)[1]]
+    return None
+#
+#  ----  listings of the table directories kept from earlier runs, keyed by path
+#        below droot, as [modification time of the directory, [variables]]. A
+#        directory's modification time changes whenever an entry is added to
+#        or removed from it, so a table directory whose time is unchanged still
+#        holds the same variables and need not be listed again. That says
+#        nothing about the directories further down, which is why only the
+#        bottom level of the crawl is cached
+cachefile = 'CCMI-2022_archive_cache.json'
+dcache = {}
+#
+#  ----  list a directory found by the crawl at the given level, given the
+#        modification time its parent reported for it, reusing the cached
+#        listing of a table directory that has not changed
+def list_level(level, path, modify):
+    if level < len(levels) - 1:
+        return list_dirs(path)
+    rpath = path[len(droot)+1:]
+    if modify is not None and rpath in dcache and dcache[rpath][0] == modify:
+        return dict.fromkeys(dcache[rpath][1])
+    print('Searching ---', rpath)
+    names = list_dirs(path)
+    dcache[rpath] = [modify, list(names)]
+    return names
+#
+#  ----  crawl the archive and return its directory structure as the nested
+#        dictionary invntry[institute][model][experiment][simulation][table]
+#        = [variables]. The archive is crawled one level at a time, with all
+#        the directories at a level listed in parallel over nconn connections.
+#        With prune set, subdirectories that cannot lead to a requested file
+#        are left out and never listed
+def build_inventory(prune):
+    nsubs = [[] for level in levels]
+#
+#      ----  the directories at the current level, each with its modification
+#            time, the dictionary its entry is to be stored in and the key to
+#            store it under
+    top = {}
+    nodes = [(droot, None, top, 'archive')]
+    with ThreadPoolExecutor(max_workers=nconn) as pool:
+        for level in range(len(levels)):
+#
+#          ----  when the whole archive is being crawled, forget the cached
+#                table directories that have been removed from it
+            if level == len(levels) - 1 and not prune:
+                tlisted = {path[len(droot)+1:] for path, modify, tree, key in nodes}
+                for rpath in set(dcache) - tlisted:
+                    del dcache[rpath]
+            listings = pool.map(functools.partial(list_level, level),
+                                [path for path, modify, tree, key in nodes],
+                                [modify for path, modify, tree, key in nodes])
+            subnodes = []
+            for (path, modify, tree, key), names in zip(nodes, listings):
+                keep = targets(level, path) if prune else None
+                if keep is not None:
+                    names = {name: names[name] for name in names if name in keep}
+                nsubs[level].append(len(names))
+                if level == len(levels) - 1:
+                    tree[key] = list(names)
+                else:
+                    tree[key] = {}
+                    subnodes.extend((path+'/'+name, names[name], tree[key], name)
+                                    for name in names)
+            nodes = subnodes
+    invntry = top['archive']
+#
+    print('Number of institutions ', len(invntry))
+    print(list(invntry))
+    for level in range(1, len(levels)):
+        print('Total number of '+levels[level]+'s ', sum(nsubs[level]))
+        print('Number of '+levels[level]+'s for each '+levels[level-1])
+        print(nsubs[level])
+    return invntry
+#
+#  ----  write a JSON file under a temporary name and only rename it once it is
+#        complete, as get_file does, so that an interrupted run or a full disk
+#        never leaves a truncated file for the next run to read
+def save_json(obj, fname, **kwargs):
+    part = fname + '.part'
+    with open(part, 'wt') as out:
+        json.dump(obj, out, **kwargs)
+    os.replace(part, fname)
+#
+#  ----  an inventory written earlier today is reused rather than crawling the
+#        whole archive again. Otherwise, if files are to be downloaded only the
+#        part of the archive holding them is crawled, and if not the whole
+#        archive is crawled and saved straight away
+if os.path.exists(invfile):
+    print('Reading the archive inventory from ', invfile)
+    with open(invfile, 'rt') as inp:
+        invntry = json.load(inp)
+else:
+#
+#  ---- the listing cache only saves time, so one that cannot be read is
+#       ignored and rebuilt by the crawl
+    if os.path.exists(cachefile):
+        try:
+            with open(cachefile, 'rt') as inp:
+                dcache.update(json.load(inp))
+        except ValueError:
+            print('Ignoring the unreadable listing cache ', cachefile)
+    if trgexpt:
+        print('Crawling only the requested experiments, tables and variables')
+        invntry = build_inventory(prune=True)
+    else:
+        invntry = build_inventory(prune=False)
+#
+#  ---- dump a list of all models/experiments/variables found in the archive
+#       as JSON so that it can be read back with json.load
+        save_json(invntry, invfile, indent=2)
+    save_json(dcache, cachefile)
 #
 #  ----  if targets are specified for download, dive down to the bottom of the
 #        directory structure and retrieve them
 tfsize=0.0
 if trgexpt:
-    wdir = os.getcwd()
 #
 # If directory doesn't exist make it
-    if not os.path.isdir(ddir):
-        os.mkdir(ddir)
-#
-# Change the local directory to where you want to put the data
-    os.chdir(ddir)
-#
-    icnt1 = 0
-    icnt2 = 0
-    icnt3 = 0
-    icnt4 = 0
-    for ia in range(ninst):
-        for ib in range(1,nmdls[ia]+1):
-            mdl = invntry[ia][ib][0]
-            for ic in range(1,nxpts[icnt1]+1):
-                expt = invntry[ia][ib][ic][0]
-                for id in range(1,nsims[icnt2]+1):
-                    rsim = invntry[ia][ib][ic][id][0]
-                    for ie in range(1,ntabs[icnt3]+1):
-                        mtab = invntry[ia][ib][ic][id][ie][0]
-                        for ig in range(1,nvars[icnt4]+1):
-                            xvar = invntry[ia][ib][ic][id][ie][ig][0]
-                            if expt in trgexpt:
-                                vpull=False
-                                for ih in range(nvsrch):
-                                    if mtab == trgtble[ih] and xvar == trgxvar[ih]: vpull=True
-                                if vpull:
-                                    print('Found ---', ia, ib, ic, id, ie, ig, mdl, expt,
-                                       rsim, mtab, xvar)
-                                    ftpc.cwd(droot+'/'+invntry[ia][0]+'/'+mdl+'/'+
-                                             expt+'/'+rsim+'/'+mtab+'/'+xvar)
-                                    inner_list = list(ftpc.mlsd())
-                                    ldirs=[]
-                                    for name, properties in inner_list:
-                                        if properties['type'] == 'dir':
-                                            ldirs.append(name)
-                                    ftpc.cwd(ldirs[0])
-#
-#                ------ there may be more than one version directory so we take
-#                       the last on the list since it should be the latest date
-                                    inner_list = list(ftpc.mlsd())
-                                    ldirs=[]
-                                    for name, properties in inner_list:
-                                        if properties['type'] == 'dir':
-                                            ldirs.append(name)
-                                    print(ldirs)
-                                    ftpc.cwd(ldirs[-1])
-#
-#                ------ finally, the list of files
-                                    inner_list = list(ftpc.mlsd())
-                                    lfiles=[]
-                                    for name, properties in inner_list:
-                                        if properties['type'] == 'file':
-                                            lfiles.append(name)
-                                    for dfile in lfiles:
-                                        ftpc.retrbinary('RETR %s' % dfile, open(dfile, "wb").write)
-#
-                        icnt4 += 1
-                    icnt3 += 1
-                icnt2 += 1
-            icnt1 += 1
-#
-#  ---- go back to the original directory
-    os.chdir(wdir)
-#
-# Close FTP connection
-ftpc.close()
-#
-#  ---- dump a list of all models/experiments/variables found in the archive
-tday = datetime.utcnow()
-dstring =  tday.strftime('%Y%m%d')
-with open('CCMI-2022_archive_'+dstring, 'wt') as out:
-    pp = pprint.PrettyPrinter(indent=4, compact=True, stream=out)
-    pp.pprint(invntry)
+    os.makedirs(ddir, exist_ok=True)
+#
+#  ----  note the files already downloaded by an earlier run, and their sizes,
+#        with a single scan of the directory so that they are not fetched again
+    dexist = {entry.name: entry.stat().st_size for entry in os.scandir(ddir)
+              if entry.is_file()}
+#
+#  ----  use the inventory to go straight to the requested experiments of
+#        each model rather than visiting every experiment in the archive, and
+#        collect the variable directories to retrieve before touching the server
+#        The path of each directory is built once from that of its parent, and
+#        an experiment named twice in trgexpt is only visited once, so that no
+#        file is retrieved by two threads at the same time
+    vpaths = []
+    for inst, models in invntry.items():
+        ipath = droot+'/'+inst
+        for mdl, expts in models.items():
+            mpath = ipath+'/'+mdl
+            for expt in dict.fromkeys(trgexpt):
+                if expt not in expts:
+                    continue
+                epath = mpath+'/'+expt
+                for rsim, tabs in expts[expt].items():
+                    spath = epath+'/'+rsim
+                    for mtab, xvars in tabs.items():
+                        if mtab not in trgvars:
+                            continue
+                        tpath = spath+'/'+mtab
+                        for xvar in xvars:
+                            if xvar in trgvars[mtab]:
+                                print('Found ---', inst, mdl, expt, rsim, mtab, xvar)
+                                vpaths.append(tpath+'/'+xvar)
+    print('Number of variable directories to retrieve ', len(vpaths))
+#
+#  ----  dive down to the bottom of all the variable directories in parallel
+#        and collect the files to retrieve, skipping those already downloaded
+#        unless the archive copy has a different size, e.g. because it was
+#        replaced by a new version
+    with ThreadPoolExecutor(max_workers=nconn) as pool:
+        dfiles = []
+        for fpath, lfiles in pool.map(find_files, vpaths):
+            if lfiles:
+                print('Latest version ---', fpath)
+            for dfile, dsize in lfiles.items():
+                if dfile in dexist and dsize in (None, dexist[dfile]):
+                    continue
+                dfiles.append((fpath, dfile, dsize))
+        print('Number of files to retrieve ', len(dfiles))
+#
+#  ----  then retrieve them, nconn at a time. If one fails for good or the
+#        run is interrupted, the transfers not yet started are cancelled so
+#        that leaving the pool only waits for those already under way
+        futures = [pool.submit(get_file, fpath, dfile, dsize)
+                   for fpath, dfile, dsize in dfiles]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+#
+# Close the FTP connections
+while not ftpool.empty():
+    ftpool.get().close()
 #